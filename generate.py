@@ -1,13 +1,32 @@
 # pylint: disable=C0103,R0903,R0913
 """Visualization for the "chaîne des Puys".
 """
-import xml.etree.ElementTree
+try:
+    from lxml import etree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 import math
 import argparse
 import codecs
+import concurrent.futures
+import functools
+import io
+import os
 import re
 import random
+import numpy
 import pandas
+try:
+    import scipy.spatial
+except ImportError:
+    scipy = None
+
+_hypot = math.hypot
+_log = math.log
+_tan = math.tan
+_randrange = random.randrange
+_QUARTER_PI = .25 * math.pi
+_RAD_PER_DEG = math.pi / 180.
 
 
 class Node:
@@ -19,32 +38,15 @@ class Node:
         self.y = y
 
     def __repr__(self):
-        return "Node<%f, %f>" % (self.x, self.y)
+        return f"Node<{self.x:f}, {self.y:f}>"
 
     def __str__(self):
-        return "%.2f %.2f" % (self.x, self.y)
-
-    def __hash__(self):
-        return hash((self.x, self.y))
-
-    def __eq__(self, other):
-        return self.x == other.x and self.y == other.y
-
-    def __add__(self, other):
-        return Node(self.x + other.x, self.y + other.y)
-
-    def __radd__(self, other):
-        if other == 0:
-            return Node(self.x, self.y)
-        raise ValueError(other)
-
-    def __truediv__(self, other):
-        return Node(self.x / other, self.y / other)
+        return f"{self.x:.2f} {self.y:.2f}"
 
     def distance(self, other):
         """Euclidian distance between two vectors.
         """
-        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2)
+        return _hypot(self.x - other.x, self.y - other.y)
 
 
 class LatLonNode(Node):
@@ -52,18 +54,32 @@ class LatLonNode(Node):
     Mercator's projection approximation.
     """
 
+    WIDTH = 679.
+    HEIGHT = 724.
+    SCALE = WIDTH / (2 * math.pi)
+
     def __init__(self, lat, lon):
         self.lat = float(lat)
         self.lon = float(lon)
-        w = 679.
-        h = 724.
-        theta = math.pi * self.lat / 180.
-        phi = math.pi * self.lon / 180.
-        x = w * (phi + math.pi) / (2 * math.pi)
-        y = .5 * h - (w / (2 * math.pi))\
-            * math.log(math.tan(.25 * math.pi + .5 * theta))
+        theta = _RAD_PER_DEG * self.lat
+        phi = _RAD_PER_DEG * self.lon
+        x = LatLonNode.SCALE * (phi + math.pi)
+        y = .5 * LatLonNode.HEIGHT - LatLonNode.SCALE\
+            * _log(_tan(_QUARTER_PI + .5 * theta))
         Node.__init__(self, x, y)
 
+    @staticmethod
+    def project_batch(lats, lons):
+        """Project arrays of latitudes and longitudes (in degrees) at once,
+        returning the corresponding arrays of coordinates.
+        """
+        theta = _RAD_PER_DEG * numpy.asarray(lats, dtype=float)
+        phi = _RAD_PER_DEG * numpy.asarray(lons, dtype=float)
+        xs = LatLonNode.SCALE * (phi + numpy.pi)
+        ys = .5 * LatLonNode.HEIGHT - LatLonNode.SCALE\
+            * numpy.log(numpy.tan(_QUARTER_PI + .5 * theta))
+        return xs, ys
+
 
 class PuyNode(LatLonNode):
     """Node with metadata.
@@ -75,6 +91,7 @@ class PuyNode(LatLonNode):
         self.visited = visited
         self.elevation = elevation
 
+    @functools.cached_property
     def full_label(self):
         """Return full label, including elevation is possible.
         """
@@ -82,6 +99,7 @@ class PuyNode(LatLonNode):
             return "%s (%dm)" % (self.label, self.elevation)
         return self.label
 
+    @functools.cached_property
     def color(self):
         """Node color encoding its visit status.
         """
@@ -91,7 +109,7 @@ class PuyNode(LatLonNode):
 
 
 class Way:
-    """Sequence of nodes.
+    """Sequence of nodes, stored as two coordinate arrays.
     """
 
     MIN_ELEVATION = 300
@@ -100,25 +118,73 @@ class Way:
 
     def __init__(self, elevation=None, is_subway=False):
         self.elevation = elevation
-        self.nodes = list()
+        self.xs = numpy.empty(0, dtype=numpy.float32)
+        self.ys = numpy.empty(0, dtype=numpy.float32)
         self.is_subway = is_subway
+        self._color = None
+        self._stroke = None
 
     def valid(self):
         """Check if the way is valid to display.
         """
-        return self.elevation is not None and len(self.nodes) > 0
+        return self.elevation is not None and len(self.xs) > 0
 
     def barycenter(self):
         """Compute the barycenter of all the way's nodes.
         """
-        return sum(self.nodes) / len(self.nodes)
+        return Node(self.xs.mean(), self.ys.mean())
+
+    def downcast(self):
+        """Downcast the way's coordinates to float32. Projected coordinates
+        only span a few thousand units and the SVG output rounds to two
+        decimals, so single precision is plenty once the way is in output
+        space, and the narrower arrays halve the bandwidth of the distance
+        queries.
+        """
+        self.xs = self.xs.astype(numpy.float32)
+        self.ys = self.ys.astype(numpy.float32)
+
+    def square_closure(self):
+        """Squared distance between the way's first and last nodes.
+        """
+        return (self.xs[0] - self.xs[-1]) ** 2\
+            + (self.ys[0] - self.ys[-1]) ** 2
+
+    @staticmethod
+    def precompute_styles(ways):
+        """Precompute the fill colors and stroke widths of a batch of ways,
+        blending elevations in a handful of vectorized passes instead of one
+        method call per way.
+        """
+        elevations = numpy.array([way.elevation for way in ways], dtype=float)
+        high = elevations > Way.MID_ELEVATION
+        percents = numpy.clip(numpy.where(
+            high,
+            (elevations - Way.MID_ELEVATION)
+            / (Way.MAX_ELEVATION - Way.MID_ELEVATION),
+            (elevations - Way.MIN_ELEVATION)
+            / (Way.MID_ELEVATION - Way.MIN_ELEVATION)), 0., 1.)[:, None]
+        starts = numpy.where(
+            high[:, None], [(27., 126., 14.)], [(255., 255., 255.)])
+        ends = numpy.where(
+            high[:, None], [(87., 53., 0.)], [(27., 126., 14.)])
+        rgbs = percents * ends + (1 - percents) * starts
+        strokes = numpy.where(elevations % 50 == 0, .6, .3)
+        for way, (r, g, b), stroke in zip(ways, rgbs, strokes):
+            if way.is_subway or way.square_closure() > 200 ** 2:
+                way._color = "transparent"
+            else:
+                way._color = "rgba(%f, %f, %f, .3)" % (r, g, b)
+            way._stroke = float(stroke)
 
     def color(self):
         """Compute the fill color based on its elevation.
         """
         if self.is_subway:
             return "transparent"
-        if self.nodes[0].distance(self.nodes[-1]) > 200:
+        if self._color is not None:
+            return self._color
+        if self.square_closure() > 200 ** 2:
             return "transparent"
         if self.elevation > Way.MID_ELEVATION:
             start, end = (27., 126., 14.), (87., 53., 0.)
@@ -136,43 +202,40 @@ class Way:
     def stroke(self):
         """Compute the stroke width based on its elevation.
         """
+        if self._stroke is not None:
+            return self._stroke
         if self.elevation % 50 == 0:
             return .6
         return .3
 
-    def sub(self, target_nodes, threshold):
-        """Given a set of target nodes, yield parts of its node list, selecting
-        nodes close to at least one target node.
+    def sub(self, target_xy, threshold, tree=None):
+        """Given an array of target points, yield parts of its node list,
+        selecting nodes close to at least one target point.
         """
-        close_nodes = [
-            list_distance(self_node, target_nodes) < threshold
-            for self_node in self.nodes
-        ]
+        close_nodes = min_square_dists(
+            self.xs, self.ys, target_xy, tree=tree) < threshold ** 2
         current_index = 0
         for is_close, length in compress_sequence(close_nodes):
             if is_close and length > 100:
                 subway = Way(elevation=self.elevation, is_subway=True)
-                left_offset = current_index + random.randint(0, 20)
-                right_offset = current_index + length - random.randint(0, 20)
-                subway.nodes = self.nodes[left_offset:right_offset]
+                left_offset = current_index + _randrange(21)
+                right_offset = current_index + length - _randrange(21)
+                subway.xs = self.xs[left_offset:right_offset]
+                subway.ys = self.ys[left_offset:right_offset]
                 yield subway
             current_index += length
 
 
 def compress_sequence(raw):
     """Given a sequence of symbols, return the list of parts of similar
-    consecutive symbols (and the part length).
+    consecutive symbols (and the part length), run-length encoded in a single
+    vectorized pass. The last part is left out, matching the historical
+    output of this function.
     """
-    sequences = list()
-    start_symbol, length = raw[0], 1
-    for symbol in raw[1:]:
-        if symbol == start_symbol:
-            length += 1
-        else:
-            sequences.append((start_symbol, length))
-            start_symbol = symbol
-            length = 1
-    return sequences
+    arr = numpy.asarray(raw, dtype=bool)
+    starts = numpy.concatenate(
+        ([0], numpy.flatnonzero(arr[1:] != arr[:-1]) + 1))
+    return list(zip(arr[starts[:-1]], numpy.diff(starts)))
 
 
 class Scaler:
@@ -186,73 +249,185 @@ class Scaler:
         self.min_y = None
         self.max_y = None
         self.aspect = None
+        self.scale_x = None
+        self.scale_y = None
 
-    def fit(self, nodes):
-        """Fit on a set nodes.
+    def fit(self, xs, ys):
+        """Fit on a set of coordinate arrays, precomputing the affine scale
+        factors so each transform is a single subtract-multiply pass.
         """
-        self.min_x = min(map(lambda node: node.x, nodes))
-        self.max_x = max(map(lambda node: node.x, nodes))
-        self.min_y = min(map(lambda node: node.y, nodes))
-        self.max_y = max(map(lambda node: node.y, nodes))
+        self.min_x = xs.min()
+        self.max_x = xs.max()
+        self.min_y = ys.min()
+        self.max_y = ys.max()
         self.aspect = (self.max_x - self.min_x) / (self.max_y - self.min_y)
+        self.scale_x = self.target / (self.max_x - self.min_x)
+        self.scale_y = self.target / self.aspect / (self.max_y - self.min_y)
         return self
 
-    def transform(self, nodes):
+    def transform(self, xs, ys):
+        """Transform a pair of coordinate arrays in place from its internal
+        parameters.
+        """
+        numpy.subtract(xs, self.min_x, out=xs)
+        numpy.multiply(xs, self.scale_x, out=xs)
+        numpy.subtract(ys, self.min_y, out=ys)
+        numpy.multiply(ys, self.scale_y, out=ys)
+
+    def transform_nodes(self, nodes):
         """Transform a set of nodes from its internal parameters.
         """
         for node in nodes:
-            node.x = (node.x - self.min_x) / (self.max_x - self.min_x)\
-                * self.target
-            node.y = (node.y - self.min_y) / (self.max_y - self.min_y)\
-                * self.target / self.aspect
+            node.x = (node.x - self.min_x) * self.scale_x
+            node.y = (node.y - self.min_y) * self.scale_y
 
 
-def load_osm(filename):
-    """Load the OSM contour file.
+OSM_PARALLEL_THRESHOLD = 8 * 2 ** 20
+
+
+def _parse_osm(source):
+    """Parse an OSM document (filename or binary file object) as a stream,
+    returning raw node ids, coordinates and ways. Elements are processed as
+    they are read and freed immediately afterwards, so the whole tree is
+    never held in memory.
     """
-    nodes, ways = dict(), list()
-    tree = xml.etree.ElementTree.parse(filename)
-    root = tree.getroot()
-    for element in root:
-        if element.tag == "node" and element.attrib.get("action") != "delete":
-            node = LatLonNode(element.attrib["lat"], element.attrib["lon"])
-            nodes[element.attrib["id"]] = node
+    node_ids, lats, lons, raw_ways = list(), list(), list(), list()
+    root = None
+    for event, element in ElementTree.iterparse(
+            source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            continue
+        if element.tag == "node":
+            if element.attrib.get("action") != "delete":
+                node_ids.append(element.attrib["id"])
+                lats.append(element.attrib["lat"])
+                lons.append(element.attrib["lon"])
         elif element.tag == "way":
-            way = Way()
+            elevation, refs = None, list()
             for subel in element:
                 if subel.tag == "nd":
-                    way.nodes.append(nodes[subel.attrib["ref"]])
+                    refs.append(subel.attrib["ref"])
                 elif subel.tag == "tag" and subel.attrib["k"] == "ele":
-                    way.elevation = int(subel.attrib["v"])
-            if way.valid():
-                ways.append(way)
-    return nodes.values(), ways
+                    elevation = int(subel.attrib["v"])
+            raw_ways.append((elevation, refs))
+        else:
+            continue
+        element.clear()
+        if root is not None:
+            root.clear()
+    return node_ids, lats, lons, raw_ways
+
+
+def _parse_osm_chunk(payload):
+    """Parse a byte slice of an OSM file holding whole top-level elements,
+    wrapped in a synthetic root so it forms a valid document.
+    """
+    return _parse_osm(io.BytesIO(b"<osm>" + payload + b"</osm>"))
+
+
+def _parse_osm_parallel(filename, workers):
+    """Split an OSM file into chunks aligned on top-level element boundaries
+    and parse them in a process pool, merging the raw results in file order.
+    Only plain lists and tuples cross the process boundary.
+    """
+    with open(filename, "rb") as infile:
+        data = infile.read()
+    start = data.find(b"<node")
+    end = data.rfind(b"</osm>")
+    if start < 0 or end < 0:
+        return _parse_osm(filename)
+    cuts = [start]
+    for i in range(1, workers):
+        target = start + (end - start) * i // workers
+        candidates = [
+            position
+            for position in (
+                data.find(b"<node", target), data.find(b"<way", target))
+            if position >= 0
+        ]
+        cuts.append(min(candidates, default=end))
+    cuts.append(end)
+    cuts = sorted(set(cuts))
+    node_ids, lats, lons, raw_ways = list(), list(), list(), list()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        chunks = (data[left:right] for left, right in zip(cuts, cuts[1:]))
+        for chunk_ids, chunk_lats, chunk_lons, chunk_ways\
+                in executor.map(_parse_osm_chunk, chunks):
+            node_ids.extend(chunk_ids)
+            lats.extend(chunk_lats)
+            lons.extend(chunk_lons)
+            raw_ways.extend(chunk_ways)
+    return node_ids, lats, lons, raw_ways
+
+
+def load_osm(filename):
+    """Load the OSM contour file. Large files are parsed by several worker
+    processes over byte-aligned chunks; node references are only resolved
+    once all chunks are merged, so ways may safely span chunk boundaries.
+    """
+    workers = os.cpu_count() or 1
+    if workers > 1 and os.path.getsize(filename) >= OSM_PARALLEL_THRESHOLD:
+        node_ids, lats, lons, raw_ways = _parse_osm_parallel(
+            filename, workers)
+    else:
+        node_ids, lats, lons, raw_ways = _parse_osm(filename)
+    xs, ys = LatLonNode.project_batch(lats, lons)
+    index = {node_id: i for i, node_id in enumerate(node_ids)}
+    ways = list()
+    for elevation, refs in raw_ways:
+        way = Way(elevation=elevation)
+        indices = numpy.array([index[ref] for ref in refs], dtype=int)
+        way.xs = xs[indices]
+        way.ys = ys[indices]
+        if way.valid():
+            ways.append(way)
+    return xs, ys, ways
 
 
 def load_csv(filename):
     """Load the CSV puys file.
     """
+    frame = pandas.read_csv(
+        filename,
+        usecols=["label", "visited", "lat", "lon", "elevation"],
+        dtype={
+            "label": str,
+            "visited": float,
+            "lat": float,
+            "lon": float,
+            "elevation": "Int64",
+        })
     nodes = list()
-    for _, row in pandas.read_csv(filename).iterrows():
-        if str(row["lat"]) == "nan" or str(row["lon"]) == "nan":
+    for row in frame.itertuples(index=False):
+        if pandas.isna(row.lat) or pandas.isna(row.lon):
             continue
-        label = row["label"]
-        if str(row["elevation"]) != "nan":
-            label += " (%dm)" % row["elevation"]
         nodes.append(PuyNode(
-            row["lat"],
-            row["lon"],
-            row["label"],
-            row["visited"] == 1,
-            (None if str(row["elevation"]) == "nan" else int(row["elevation"]))
+            row.lat,
+            row.lon,
+            row.label,
+            row.visited == 1,
+            (None if pandas.isna(row.elevation) else int(row.elevation))
         ))
     return nodes
 
 
-def list_distance(target, references):
-    """Compute the minimum distance from a point to a list of points.
+def min_square_dists(xs, ys, targets, tree=None):
+    """Compute, for each point of a pair of coordinate arrays, the minimum
+    squared distance to an array of target points. When a KD-tree built over
+    the targets is provided, query it in O(n log m); otherwise fall back to
+    the expansion ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b so the pairwise
+    matrix comes out of a single BLAS-backed matrix product.
     """
-    return min({target.distance(node) for node in references})
+    points = numpy.stack((xs, ys), axis=1)
+    if tree is not None:
+        dists = tree.query(points, k=1)[0]
+        return dists * dists
+    square_dists = (points * points).sum(axis=1, keepdims=True)\
+        + (targets * targets).sum(axis=1)\
+        - 2. * points @ targets.T
+    return square_dists.min(axis=1)
 
 
 class SvgBuilder:
@@ -287,62 +462,79 @@ class SvgBuilder:
             self.HTML_TEMPLATE = infile.read()
 
     def _select_ways(self, contour_ways, puy_nodes):
+        puy_xy = numpy.array([[node.x, node.y] for node in puy_nodes])
+        tree = None
+        if scipy is not None:
+            tree = scipy.spatial.cKDTree(puy_xy)
         contour_ways.sort(key=lambda way: way.elevation)
-        for way in contour_ways:
+        barycenter_square_dists = min_square_dists(
+            numpy.array([way.xs.mean() for way in contour_ways]),
+            numpy.array([way.ys.mean() for way in contour_ways]),
+            puy_xy, tree=tree)
+        for way, barycenter_square_dist in zip(
+                contour_ways, barycenter_square_dists):
             rejected = False
-            if list_distance(way.barycenter(), puy_nodes)\
-                    > self.way_distance_threshold:
+            if barycenter_square_dist > self.way_distance_threshold ** 2:
                 rejected = True
-            elif way.nodes[0].distance(way.nodes[-1])\
-                    > self.way_closure_threshold:
+            elif way.square_closure() > self.way_closure_threshold ** 2:
                 rejected = True
             if not rejected:
                 yield way
             else:
-                for subway in way.sub(puy_nodes, self.way_node_distance_threshold):
+                for subway in way.sub(
+                        puy_xy, self.way_node_distance_threshold, tree=tree):
                     yield subway
 
     def build(self, contour_ways, puy_nodes, department):
         """Output SVG text.
         """
-        placed_nodes = set()
-        svg_data = """<g id="scene"><g stroke-linejoin="round" >"""
-        path_data = "M %s" % str(department.nodes[0])
-        for node in department.nodes[1:-1:10]:
-            path_data += " L %s" % str(node)
-        svg_data += """<path stroke="grey" fill="transparent" stroke-width="1" d="%s" />\n""" % (
-            path_data
-        )
-        svg_data += """</g><g stroke-linejoin="round">"""
+        Way.precompute_styles(contour_ways)
+        placed_xs, placed_ys = list(), list()
+        svg_parts = ["""<g id="scene"><g stroke-linejoin="round" >"""]
+        department_path = f"M {department.xs[0]:.2f} {department.ys[0]:.2f}"\
+            + "".join(
+                f" L {x:.2f} {y:.2f}"
+                for x, y in zip(
+                    department.xs[1:-1:10], department.ys[1:-1:10]))
+        svg_parts.append(
+            """<path stroke="grey" fill="transparent" stroke-width="1" d="%s" />\n""" % (
+                department_path
+            ))
+        svg_parts.append("""</g><g stroke-linejoin="round">""")
         for way in self._select_ways(contour_ways, puy_nodes):
             if way.is_subway:
-                path_data = "M %s" % str(way.nodes[0])
+                path_parts = [f"M {way.xs[0]:.2f} {way.ys[0]:.2f}"]
             else:
-                path_data = "M %s" % str(way.nodes[-1])
-            for node in way.nodes:
-                path_data += " L %s" % str(node)
-                placed_nodes.add(node)
-            svg_data += """<path fill="%s" d="%s" stroke="%s" stroke-width="%s" />\n""" % (
-                way.color(),
-                path_data,
-                ("url(#Gradient1)" if way.is_subway else "black"),
-                way.stroke())
-        svg_data += "</g><g>"
+                path_parts = [f"M {way.xs[-1]:.2f} {way.ys[-1]:.2f}"]
+            for x, y in zip(way.xs, way.ys):
+                path_parts.append(f" L {x:.2f} {y:.2f}")
+            placed_xs.append(way.xs)
+            placed_ys.append(way.ys)
+            svg_parts.append(
+                """<path fill="%s" d="%s" stroke="%s" stroke-width="%s" />\n""" % (
+                    way.color(),
+                    "".join(path_parts),
+                    ("url(#Gradient1)" if way.is_subway else "black"),
+                    way.stroke()))
+        svg_parts.append("</g><g>")
         for node in puy_nodes:
-            placed_nodes.add(node)
-            svg_data += """<g class="puy">
+            placed_xs.append(numpy.array([node.x]))
+            placed_ys.append(numpy.array([node.y]))
+            svg_parts.append("""<g class="puy">
                 <circle cx="%f" cy="%f" r="3" fill="%s" stroke="black" />
                 <text x="%f" y="%f" text-anchor="middle" stroke="white" dy="-7">%s</text>
             </g>\n""" % (
                 node.x,
                 node.y,
-                node.color(),
+                node.color,
                 node.x,
                 node.y,
-                node.full_label()
-            )
-        svg_data += "</g></g>"
-        scaler = Scaler().fit(placed_nodes)
+                node.full_label
+            ))
+        svg_parts.append("</g></g>")
+        svg_data = "".join(svg_parts)
+        scaler = Scaler().fit(
+            numpy.concatenate(placed_xs), numpy.concatenate(placed_ys))
         return self.TEMPLATE_SVG.format(
             width=scaler.max_x - scaler.min_x,
             height=scaler.max_y - scaler.min_y,
@@ -364,13 +556,16 @@ def load_poly(filename):
         polygon = Way()
         polygon_title = lines[i].strip()
         i += 1
+        lats, lons = list(), list()
         while i < len(lines):
             if lines[i].strip() == "END":
                 i += 1
                 break
             lon, lat = re.split("[\t ]+", lines[i].strip())
-            polygon.nodes.append(LatLonNode(lat, lon))
+            lats.append(lat)
+            lons.append(lon)
             i += 1
+        polygon.xs, polygon.ys = LatLonNode.project_batch(lats, lons)
         polygons[polygon_title] = polygon
     return title, polygons
 
@@ -378,16 +573,19 @@ def load_poly(filename):
 def main(args):
     """Parse arguments.
     """
-    contour_nodes, contour_ways = load_osm(args.osm)
+    contour_xs, contour_ys, contour_ways = load_osm(args.osm)
     scaler = Scaler()
-    scaler.fit(contour_nodes)
-    scaler.transform(contour_nodes)
+    scaler.fit(contour_xs, contour_ys)
+    for way in contour_ways:
+        scaler.transform(way.xs, way.ys)
+        way.downcast()
     puy_nodes = load_csv(args.csv)
     puy_nodes.sort(key=lambda node: node.y)
     visited = len({p for p in puy_nodes if p.visited})
-    scaler.transform(puy_nodes)
+    scaler.transform_nodes(puy_nodes)
     department = load_poly(args.poly)[1]["1"]
-    scaler.transform(department.nodes)
+    scaler.transform(department.xs, department.ys)
+    department.downcast()
     builder = SvgBuilder(
         args.way_distance_threshold,
         args.way_closure_threshold,